@@ -1,52 +1,95 @@
 #!/usr/bin/env python3
-import json
+import gzip
+import os
+import tarfile
 from pathlib import Path
 import base64
 
+try:
+    from pybase64 import b64encode
+except ImportError:  # stdlib is scalar but always available
+    b64encode = base64.b64encode
+
+JS_PLACEHOLDER = '"INSERT_CUSTOM_CODE_HERE"'
+
+# 57 KiB is a multiple of 3, so each chunk encodes to base64 with no
+# mid-stream padding and the pieces can be concatenated directly.
+B64_CHUNK_SIZE = 57 * 1024
+
+def walk_py(root: str):
+    """Yield (rel_path, full_path) for every .py file under root, using a
+    stack-based os.scandir walk (cheaper than Path.rglob per entry)."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".py"):
+                    rel = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                    yield (rel, entry.path)
+
+def write_archive(out_path: Path, py_files):
+    """Pack py_files into a gzip-compressed tar. Timestamps and ownership
+    are normalized so identical trees produce identical bytes, which keeps
+    the client's ETag cache valid across rebuilds. Written via a temp file
+    + os.replace so a failed run never leaves a truncated archive."""
+    tmp_path = out_path.with_suffix(out_path.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode="w|") as tar:
+                for rel_path, full_path in py_files:
+                    info = tarfile.TarInfo(name=rel_path)
+                    info.size = os.stat(full_path).st_size
+                    with open(full_path, "rb") as fp:
+                        tar.addfile(info, fp)
+    os.replace(tmp_path, out_path)
+
 def main():
     base_dir = Path("/custom_pkgs")
-    output_json = Path("/custom.json")
+    output_tar = Path("/custom.tar.gz")
     custom_js_path = Path("/customCode.GET.js")  # <--- added
 
     if not base_dir.is_dir():
         raise SystemExit(f"Base directory does not exist: {base_dir}")
 
-    files_dict = {}
-
-    # Recursively find all .py files
-    for py_file in sorted(base_dir.rglob("*.py")):
-        rel_path = py_file.relative_to(base_dir).as_posix()
-        raw_bytes = py_file.read_bytes()  # read as raw binary
-        encoded = base64.b64encode(raw_bytes).decode("utf-8")
-        files_dict[rel_path] = encoded
-
-    # -----------------------------
-    # 1. Write /custom.json
-    # -----------------------------
-    with output_json.open("w", encoding="utf-8") as f:
-        json.dump(files_dict, f, ensure_ascii=False, indent=2)
-
-    print(f"Wrote {len(files_dict)} files to {output_json}")
-
-    # -----------------------------
-    # 2. Insert JSON into customCode.GET.js
-    # -----------------------------
     if not custom_js_path.exists():
         raise SystemExit(f"custom JS file not found: {custom_js_path}")
 
-    # Read entire JS file as text
-    js_text = custom_js_path.read_text(encoding="utf-8")
+    # Recursively find all .py files
+    py_files = sorted(walk_py(str(base_dir)))
 
-    # Read JSON exactly as a string (including newlines)
-    raw_json = output_json.read_text(encoding="utf-8")
+    write_archive(output_tar, py_files)
+    print(f"Packed {len(py_files)} files into {output_tar}")
+
+    # Read the JS template and locate the placeholder once
+    js_text = custom_js_path.read_text(encoding="utf-8")
+    idx = js_text.index(JS_PLACEHOLDER)
 
-    # Replace the *quoted* placeholder with **raw JSON**
-    updated_js = js_text.replace('"INSERT_CUSTOM_CODE_HERE"', raw_json)
+    # Splice the base64 of the archive into the JS as a plain JSON string.
+    # The encoded size is known up front (((n+2)//3)*4), so the payload is
+    # assembled in one preallocated buffer -- no realloc churn -- and the
+    # output file gets a 1 MiB write buffer to keep syscalls few.
+    est_b64 = ((output_tar.stat().st_size + 2) // 3) * 4
+    payload = bytearray(est_b64)
+    view = memoryview(payload)
+    pos = 0
+    with output_tar.open("rb") as tar_f:
+        while chunk := tar_f.read(B64_CHUNK_SIZE):
+            enc = b64encode(chunk)
+            view[pos:pos + len(enc)] = enc
+            pos += len(enc)
 
-    # Overwrite JS file
-    custom_js_path.write_text(updated_js, encoding="utf-8")
+    custom_js_tmp = custom_js_path.with_suffix(custom_js_path.suffix + ".new")
+    with custom_js_tmp.open("wb", buffering=1 << 20) as js_f:
+        js_f.write(js_text[:idx].encode("utf-8"))
+        js_f.write(b'"')
+        js_f.write(view[:pos])
+        js_f.write(b'"')
+        js_f.write(js_text[idx + len(JS_PLACEHOLDER):].encode("utf-8"))
+    os.replace(custom_js_tmp, custom_js_path)
 
-    print(f"Inserted raw JSON into {custom_js_path}")
+    print(f"Inserted archive into {custom_js_path}")
 
 if __name__ == "__main__":
     main()
@@ -1,17 +1,27 @@
 import asyncio
+import io
 import pyodide
 from js import globalThis, console, fetch
 import sys
-import json
+import tarfile
 from pathlib import Path
 import base64
 
+try:
+    # SIMD-accelerated when available; in Pyodide fall back to stdlib.
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    _b64decode = base64.b64decode
+
 # request ID system
 _next_id = 1
 _pending = {}
 
 VIRTUAL_ROOT = "/custom_pkgs"
 
+CUSTOM_CODE_URL = "https://quadraticapi.kountouris.org/v0/customCode"
+CUSTOM_CODE_CACHE = "custom-code-cache"
+
 def _on_message(event):
     try:
         data = event.data.to_py()
@@ -52,15 +62,41 @@ async def get_ory_token():
     return token
 
 async def get_data(token):
-    response = await fetch("https://quadraticapi.kountouris.org/v0/customCode", pyodide.ffi.to_js({
+    # Workers have no localStorage, so the bundle is cached in the Cache
+    # Storage API and revalidated with If-None-Match on later spin-ups.
+    cache = None
+    cached = None
+    etag = None
+    try:
+        cache = await globalThis.caches.open(CUSTOM_CODE_CACHE)
+        cached = await cache.match(CUSTOM_CODE_URL)
+        if cached:
+            etag = cached.headers.get("etag")
+    except Exception as e:
+        console.log(f"[Worker] cache storage unavailable: {e}")
+
+    headers = {"Authorization": f"Bearer {token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+
+    response = await fetch(CUSTOM_CODE_URL, pyodide.ffi.to_js({
         "method": "GET",
-        "headers": {
-            "Authorization": f"Bearer {token}"
-        }
+        "headers": headers
     }, dict_converter=globalThis.Object.fromEntries))
-    
+
+    if response.status == 304 and cached is not None:
+        data = await cached.json()
+        return data.to_py(), etag
+
+    if cache is not None and response.ok:
+        try:
+            await cache.put(CUSTOM_CODE_URL, response.clone())
+        except Exception as e:
+            console.log(f"[Worker] cache put failed: {e}")
+
+    etag = response.headers.get("etag")
     data = await response.json()
-    return data.to_py()
+    return data.to_py(), etag
 
 def _ensure_virtual_root():
     """Create /custom_pkgs and add it to sys.path if needed."""
@@ -75,21 +111,25 @@ def _ensure_virtual_root():
         sys.path.append(VIRTUAL_ROOT)
 
 
-def install_virtual_package(files: dict[str, str]):
+# Multiple of 4, so each slice is a valid base64 unit on its own.
+_B64_DECODE_CHUNK = 4096
+
+def install_custom_archive(archive_b64: str):
     """
-    files: mapping of relative paths (e.g. 'my_pkg/__init__.py')
-           to Python source code strings.
+    archive_b64: base64-encoded .tar.gz of the custom package tree,
+    as produced by make_custom.py on the API side.
     """
     _ensure_virtual_root()
 
-    for relpath, src in files.items():
-        abs_path = Path(VIRTUAL_ROOT) / relpath
+    # Decode in chunks (multiples of 4, so valid base64 units), then
+    # extract straight from memory in one pass.
+    buf = io.BytesIO()
+    for i in range(0, len(archive_b64), _B64_DECODE_CHUNK):
+        buf.write(_b64decode(archive_b64[i:i + _B64_DECODE_CHUNK]))
+    buf.seek(0)
 
-        # Make parent directories
-        abs_path.parent.mkdir(parents=True, exist_ok=True)
-
-        # Write file content
-        abs_path.write_text(base64.b64decode(src).decode("utf-8"), encoding="utf-8")
+    with tarfile.open(fileobj=buf, mode="r:gz") as tar:
+        tar.extractall(VIRTUAL_ROOT)
 
 async def apply_custom_patch():
     if VIRTUAL_ROOT in sys.path:
@@ -100,9 +140,16 @@ async def apply_custom_patch():
     token = await get_ory_token()
     globalThis.removeEventListener("message", listener)
     if(isinstance(token, str) and token):
-        data = await get_data(token)
-        console.log(json.dumps(data))
+        data, etag = await get_data(token)
 
         _ensure_virtual_root()
-        install_virtual_package(data["code"])
+
+        # Skip the unpack entirely if this FS already holds the same bundle
+        marker = Path(VIRTUAL_ROOT) / ".etag"
+        if etag and marker.exists() and marker.read_text() == etag:
+            return
+
+        install_custom_archive(data["code"])
+        if etag:
+            marker.write_text(etag)
 
@@ -0,0 +1,14 @@
+"""Shared .env parsing for init-local.py and start.py."""
+import re
+
+# One scan over the whole file instead of per-line strip/split/strip calls.
+# Comment lines can't match because keys must start with a letter or '_';
+# an optional layer of quotes around the value is dropped. The trailing
+# class eats the CR of CRLF files ($ matches before the \n only).
+_ENV_RE = re.compile(
+    r"""(?m)^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*["']?(.*?)["']?[ \t\r]*$"""
+)
+
+
+def parse_env(text: str) -> dict:
+    return dict(_ENV_RE.findall(text))
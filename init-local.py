@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import os
 import re
 import stat
@@ -9,6 +10,8 @@ from pathlib import Path
 import secrets
 import urllib.request
 
+from env_utils import parse_env
+
 REPO = "https://github.com/quadratichq/quadratic-selfhost.git"
 SELF_HOSTING_URI = "https://selfhost.quadratichq.com/"
 INVALID_LICENSE_KEY = "Invalid license key."
@@ -24,6 +27,31 @@ UUID_REGEX = re.compile(
     r"[0-9a-fA-F]{12}$"
 )
 
+def is_valid_uuid(s: str) -> bool:
+    # Cheap length/hyphen shape check rejects obviously-wrong input before
+    # the regex engine runs; the regex then does canonical validation.
+    if len(s) != 36 or s[8] != "-" or s[13] != "-" or s[18] != "-" or s[23] != "-":
+        return False
+    return UUID_REGEX.match(s) is not None
+
+def atomic_write(path: Path, data) -> None:
+    """Write via a temp file + os.replace so a crash mid-write can't leave
+    a half-written config behind."""
+    if isinstance(data, str):
+        data = data.encode()
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+def copy_if_changed(src: Path, dst: Path) -> bool:
+    """Copy src over dst unless dst already has identical content, so
+    re-runs skip the write (and the containing read is one pass)."""
+    data = src.read_bytes()
+    if dst.exists() and dst.read_bytes() == data:
+        return False
+    atomic_write(dst, data)
+    return True
+
 def get_license_key_interactive() -> str:
     prompt = (
         f"Enter your license key "
@@ -31,12 +59,14 @@ def get_license_key_interactive() -> str:
     )
     user_input = input(prompt).strip()
 
-    if UUID_REGEX.match(user_input):
+    if is_valid_uuid(user_input):
         return user_input
     print(INVALID_LICENSE_KEY)
     sys.exit(1)
 
 def checkout_repo():
+    # cwd= on each git call instead of os.chdir, so process-global state
+    # stays untouched (a prerequisite for running anything concurrently).
     if not REPO_DIR.exists():
         print(f"Cloning {REPO} into {REPO_DIR} (sparse checkout: docker/ only)...")
         # clone without checking out files
@@ -45,38 +75,19 @@ def checkout_repo():
             check=True,
             cwd=BASE_DIR,
         )
-        os.chdir(REPO_DIR)
         # enable sparse checkout and select only what we need
-        subprocess.run(["git", "sparse-checkout", "init", "--cone"], check=True)
-        subprocess.run(["git", "sparse-checkout", "set", "docker"], check=True)
-        subprocess.run(["git", "checkout"], check=True)
+        subprocess.run(["git", "sparse-checkout", "init", "--cone"], check=True, cwd=REPO_DIR)
+        subprocess.run(["git", "sparse-checkout", "set", "docker"], check=True, cwd=REPO_DIR)
+        subprocess.run(["git", "checkout"], check=True, cwd=REPO_DIR)
     else:
         print(f"Repository directory already exists at {REPO_DIR}, updating sparse checkout.")
-        os.chdir(REPO_DIR)
         # ensure sparse checkout still targets only docker/
-        subprocess.run(["git", "sparse-checkout", "init", "--cone"], check=True)
-        subprocess.run(["git", "sparse-checkout", "set", "docker"], check=True)
-        subprocess.run(["git", "pull", "--ff-only"], check=True)
-
-def load_env_file(env_path: Path) -> dict:
-    env = {}
-    if not env_path.exists():
-        return env
-
-    for line in env_path.read_text().splitlines():
-        line = line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-        key, value = line.split("=", 1)
-        key = key.strip()
-        value = value.strip().strip('"').strip("'")
-        env[key] = value
-    return env
-
-
-def parse_profile(env_path: Path) -> str:
-    env = load_env_file(env_path)
+        subprocess.run(["git", "sparse-checkout", "init", "--cone"], check=True, cwd=REPO_DIR)
+        subprocess.run(["git", "sparse-checkout", "set", "docker"], check=True, cwd=REPO_DIR)
+        subprocess.run(["git", "pull", "--ff-only"], check=True, cwd=REPO_DIR)
 
+def parse_profile(env) -> list[str]:
+    # env: an already-parsed mapping of .env keys to values.
     variables = [
         "DATABASE_IN_DOCKER_COMPOSE",
         "PUBSUB_IN_DOCKER_COMPOSE",
@@ -97,28 +108,48 @@ def parse_profile(env_path: Path) -> str:
         "QUADRATIC_CONNECTION_DB_MSSQL_SSH_IN_DOCKER_COMPOSE",
     ]
 
+    # Flat argument tokens: joining and re-splitting on spaces would break
+    # the round-trip through the PROFILE file for any value with a space.
     values = []
     for var_name in variables:
         raw_val = env.get(var_name, "")
         if raw_val.lower() == "true":
             stripped = var_name.replace("_IN_DOCKER_COMPOSE", "")
-            lowered = stripped.lower()
-            values.append(f"--profile {lowered}")
+            values.extend(("--profile", stripped.lower()))
+
+    return values
 
-    return " ".join(values)
+def _walk_sh(root: str):
+    """Yield every .sh file under root via a stack-based os.scandir walk."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".sh") and entry.is_file(follow_symlinks=False):
+                    yield entry.path
 
 def normalize_line_endings(repo_dir: Path) -> None:
     # Force LF endings for all shell scripts in the repo
-    for path in repo_dir.rglob("*.sh"):
-        if path.is_file():
-            data = path.read_bytes()
-            new = data.replace(b"\r\n", b"\n")
-            if new != data:
-                path.write_bytes(new)
-                print(f"Normalized line endings to LF in {path}")
+    for path in _walk_sh(str(repo_dir)):
+        with open(path, "rb") as f:
+            head = f.read(65536)
+            # Common case: small file with no CR at all -- nothing to do.
+            if b"\r" not in head and len(head) < 65536:
+                continue
+            data = head + f.read()
+        new = data.replace(b"\r\n", b"\n")
+        if new != data:
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(new)
+            os.chmod(tmp, os.stat(path).st_mode)
+            os.replace(tmp, path)
+            print(f"Normalized line endings to LF in {path}")
 
 def generate_random_encryption_key() -> str:
-    enc = Path("ENCRYPTION_KEY")
+    enc = REPO_DIR / "ENCRYPTION_KEY"
     if enc.exists():
         text = enc.read_text()
             
@@ -129,21 +160,40 @@ def generate_random_encryption_key() -> str:
     
     return secrets.token_hex(32)
 
-def build_custom_quadratic_api():
-    # Paths
-    custom_dir = Path("custom-api")
-    # 2) Build Docker image
-    print("[+] Building Docker image 'my-quadratic-api'...")
-    subprocess.check_call(["docker", "build", "-t", "my-quadratic-api", str(custom_dir)])
+def _docker_build(tag: str, custom_dir: Path):
+    # BuildKit with a persistent local layer cache: repeat builds reuse
+    # every unchanged layer instead of rebuilding from the base image.
+    # The cached path needs buildx with a driver that supports cache
+    # export; if anything about it fails (no buildx plugin, default
+    # docker driver, ...), fall back to the classic docker build the
+    # baseline used -- DOCKER_BUILDKIT=1 still enables BuildKit there
+    # when the engine has it.
+    cache_dir = f"/tmp/dockercache-{tag}"
+    env = {**os.environ, "DOCKER_BUILDKIT": "1"}
+    print(f"[+] Building Docker image '{tag}'...")
+    try:
+        subprocess.check_call(
+            [
+                "docker", "buildx", "build", "--load",
+                "--cache-from", f"type=local,src={cache_dir}",
+                "--cache-to", f"type=local,dest={cache_dir},mode=max",
+                "-t", tag, str(custom_dir),
+            ],
+            env=env,
+        )
+    except subprocess.CalledProcessError:
+        print("[!] Cached buildx build failed; retrying with plain docker build.")
+        subprocess.check_call(
+            ["docker", "build", "-t", tag, str(custom_dir)],
+            env=env,
+        )
     print("[✓] Done!")
 
+def build_custom_quadratic_api():
+    _docker_build("my-quadratic-api", BASE_DIR / "custom-api")
+
 def build_custom_quadratic_client():
-    # Paths
-    custom_dir = Path("custom-client")
-    # 2) Build Docker image
-    print("[+] Building Docker image 'my-quadratic-client'...")
-    subprocess.check_call(["docker", "build", "-t", "my-quadratic-client", str(custom_dir)])
-    print("[✓] Done!")
+    _docker_build("my-quadratic-client", BASE_DIR / "custom-client")
 
 def main():
     parser = argparse.ArgumentParser(
@@ -164,7 +214,7 @@ def main():
         license_key = existing_license_file.read_text().strip()
         print(f"Using existing license key from {existing_license_file}")
     elif args.license_key:
-        if not UUID_REGEX.match(args.license_key.strip()):
+        if not is_valid_uuid(args.license_key.strip()):
             print(INVALID_LICENSE_KEY)
             sys.exit(1)
         license_key = args.license_key.strip()
@@ -173,62 +223,70 @@ def main():
         license_key = get_license_key_interactive()
 
     # 2) Retrieve code from GitHub
-    checkout_repo()  # cwd is now REPO_DIR
+    checkout_repo()
     normalize_line_endings(REPO_DIR)
 
     # 3) Copy local config files
     kratos_local = BASE_DIR / "custom-compose" / "kratos.yml"
-    kratos_target = Path("docker/ory-auth/config/kratos.yml")
+    kratos_target = REPO_DIR / "docker/ory-auth/config/kratos.yml"
     if kratos_local.exists():
-        kratos_target.write_text(kratos_local.read_text())
-        print(f"Copied {kratos_local} -> {kratos_target}")
+        if copy_if_changed(kratos_local, kratos_target):
+            print(f"Copied {kratos_local} -> {kratos_target}")
+        else:
+            print(f"{kratos_target} already up to date.")
     else:
         print(f"WARNING: {kratos_local} does not exist.")
 
     env_local_orig = BASE_DIR / "custom-compose" / ".env.local"
-    env_local = Path(".env.local")
+    env_local = REPO_DIR / ".env.local"
     if env_local_orig.exists():
-        env_local.write_text(env_local_orig.read_text())
-        print(f"Copied {env_local_orig} -> {env_local}")
+        if copy_if_changed(env_local_orig, env_local):
+            print(f"Copied {env_local_orig} -> {env_local}")
+        else:
+            print(f"{env_local} already up to date.")
     else:
         print(f"WARNING: {env_local_orig} does not exist.")
 
-    env_file = Path(".env")
-    if env_local.exists():
-        env_file.write_text(env_local.read_text())
-        print(f"Copied {env_local} -> {env_file}")
-    else:
-        print(f"WARNING: {env_local} does not exist.")
-
     # 4) Write LICENSE_KEY
-    license_path = Path("LICENSE_KEY")
-    license_path.write_text(license_key + "\n")
+    license_path = REPO_DIR / "LICENSE_KEY"
+    atomic_write(license_path, license_key + "\n")
     print(f"Wrote LICENSE_KEY to {license_path}")
 
-    # 5) PROFILE
-    profile_str = parse_profile(env_file)
-    profile_path = Path("PROFILE")
-    profile_path.write_text(profile_str + "\n")
-    print(f"Wrote PROFILE: {profile_str!r}")
-
-    # 6) ENCRYPTION_KEY
+    # 5) ENCRYPTION_KEY (generated before .env so it can be substituted below)
     encryption_key = generate_random_encryption_key()
-    encryption_path = Path("ENCRYPTION_KEY")
-    encryption_path.write_text(encryption_key + "\n")
+    encryption_path = REPO_DIR / "ENCRYPTION_KEY"
+    atomic_write(encryption_path, encryption_key + "\n")
     print(f"Wrote ENCRYPTION_KEY ({len(encryption_key)} hex chars).")
 
-    # 7) Replace placeholders in .env
-    if env_file.exists():
-        content = env_file.read_text()
-        content = content.replace("#LICENSE_KEY#", license_key)
-        content = content.replace("#ENCRYPTION_KEY#", encryption_key)
-        env_file.write_text(content)
-        print("Replaced #LICENSE_KEY# and #ENCRYPTION_KEY# in .env")
+    # 6) Produce .env from .env.local in one pass, placeholders already
+    # substituted -- no intermediate .env with raw #...# markers on disk.
+    env_file = REPO_DIR / ".env"
+    env = {}
+    if env_local.exists():
+        content = (
+            env_local.read_text()
+            .replace("#LICENSE_KEY#", license_key)
+            .replace("#ENCRYPTION_KEY#", encryption_key)
+        )
+        atomic_write(env_file, content)
+        env = parse_env(content)
+        print(f"Wrote {env_file} from {env_local} with placeholders substituted")
+
+        # Persist the parsed result so start.py can skip re-parsing .env
+        env_parsed = REPO_DIR / ".env.parsed.json"
+        atomic_write(env_parsed, json.dumps(env))
+        print(f"Wrote parsed env to {env_parsed}")
     else:
-        print("WARNING: .env not found; skipping placeholder replacement.")
+        print(f"WARNING: {env_local} does not exist; .env not written.")
+
+    # 7) PROFILE
+    profile_args = parse_profile(env)
+    profile_path = REPO_DIR / "PROFILE"
+    atomic_write(profile_path, "\n".join(profile_args) + "\n")
+    print(f"Wrote PROFILE: {profile_args!r}")
 
     # 8) chmod +x docker/postgres/scripts/init.sh
-    init_sh = Path("docker/postgres/scripts/init.sh")
+    init_sh = REPO_DIR / "docker/postgres/scripts/init.sh"
     if init_sh.exists():
         st = init_sh.stat()
         init_sh.chmod(st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
@@ -237,26 +295,25 @@ def main():
         print(f"WARNING: {init_sh} not found; skipping chmod.")
 
     # 9) Build custom api
-    os.chdir(BASE_DIR)
     build_custom_quadratic_api()
     build_custom_quadratic_client()
     docker_compose_orig = BASE_DIR / "custom-compose" / "docker-compose.yml"
     docker_compose = REPO_DIR / "docker-compose.yml"
     if docker_compose_orig.exists():
-        docker_compose.write_text(docker_compose_orig.read_text())
-        print(f"Copied {docker_compose_orig} -> {docker_compose}")
+        if copy_if_changed(docker_compose_orig, docker_compose):
+            print(f"Copied {docker_compose_orig} -> {docker_compose}")
+        else:
+            print(f"{docker_compose} already up to date.")
     else:
         print(f"WARNING: {docker_compose_orig} does not exist.")
 
     # 10) Call start.py instead of sh start.sh
-    os.chdir(REPO_DIR)
-    start_py = Path("../start.py")
+    start_py = BASE_DIR / "start.py"
     if start_py.exists():
         print("Running start.py...")
-        subprocess.run([sys.executable, str(start_py)], check=True)
+        subprocess.run([sys.executable, str(start_py)], check=True, cwd=REPO_DIR)
     else:
         print("WARNING: start.py not found; not starting services.")
-    os.chdir(BASE_DIR)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import json
 import os
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from env_utils import parse_env
+
 
 BASE_DIR = Path.cwd()
 ENV_PATH = BASE_DIR / ".env"
@@ -23,30 +27,32 @@ def load_env_into_os(env_path: Path):
         print(f"WARNING: {env_path} does not exist, skipping env load.")
         return
 
-    for line in env_path.read_text().splitlines():
-        line = line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-        key, value = line.split("=", 1)
-        key = key.strip()
-        value = value.strip().strip('"').strip("'")
-        os.environ[key] = value
+    # init-local.py leaves a pre-parsed copy next to .env; use it if it is
+    # at least as new as .env so we skip re-parsing.
+    parsed_path = env_path.with_name(env_path.name + ".parsed.json")
+    if (
+        parsed_path.exists()
+        and parsed_path.stat().st_mtime_ns >= env_path.stat().st_mtime_ns
+    ):
+        os.environ.update(json.loads(parsed_path.read_text()))
+        return
+
+    os.environ.update(parse_env(env_path.read_text()))
 
 
 def read_profile_args(profile_path: Path) -> list[str]:
     """
-    PROFILE file contains something like:
-      --profile database --profile quadratic_client ...
-    We split that into arg tokens for docker compose.
+    PROFILE file contains one docker compose arg token per line:
+      --profile
+      database
+      ...
+    so tokens survive the round-trip verbatim, no splitting needed.
     """
     if not profile_path.exists():
         print(f"WARNING: {profile_path} does not exist, using no profiles.")
         return []
 
-    raw = profile_path.read_text().strip()
-    if not raw:
-        return []
-    return raw.split()
+    return [line for line in profile_path.read_text().splitlines() if line]
 
 
 def main():
@@ -65,23 +71,33 @@ def main():
         print("       They are required to build cloud controller/worker image names.")
         sys.exit(1)
 
-    # 3) docker compose ... down --volumes --remove-orphans
-    print("Stopping existing containers (docker compose down)...")
-    down_cmd = ["docker", "compose"] + profile_args + [
-        "down", "--volumes", "--remove-orphans"
-    ]
-    subprocess.run(down_cmd, check=False)  # don't hard fail if nothing is running
-
-    # 4) Check cloud controller/workers
+    # 3) + 4) docker compose down and the image pulls are all independent
+    # (the new images aren't in use yet), so run them concurrently; the
+    # pull phase then costs max(controller, worker) instead of their sum.
     cloud_controller_image = f"{ecr_url}/quadratic-cloud-controller:{image_tag}"
     cloud_worker_image = f"{ecr_url}/quadratic-cloud-worker:{image_tag}"
 
+    print("Stopping existing containers (docker compose down)...")
     print(f"Pulling cloud controller image: {cloud_controller_image}")
-    pull_controller = subprocess.run(
-        ["docker", "pull", cloud_controller_image],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+    print(f"Pulling cloud worker image: {cloud_worker_image}")
+
+    down_cmd = ["docker", "compose"] + profile_args + [
+        "down", "--volumes", "--remove-orphans"
+    ]
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        # don't hard fail if nothing is running
+        down_future = ex.submit(subprocess.run, down_cmd, check=False)
+        pull_futures = [
+            ex.submit(
+                subprocess.run,
+                ["docker", "pull", image],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for image in (cloud_controller_image, cloud_worker_image)
+        ]
+        down_future.result()
+        pull_controller, pull_worker = [f.result() for f in pull_futures]
 
     if pull_controller.returncode != 0:
         print(
@@ -90,18 +106,28 @@ def main():
         )
         subprocess.run(["docker", "pull", "hello-world"], check=True)
         subprocess.run(["docker", "tag", "hello-world", cloud_controller_image], check=True)
+    elif pull_worker.returncode != 0:
+        print(f"ERROR: failed to pull worker image {cloud_worker_image}.")
+        sys.exit(1)
     else:
-        print(f"Cloud controller image pulled successfully. Pulling worker image: {cloud_worker_image}")
-        subprocess.run(["docker", "pull", cloud_worker_image], check=True)
+        print("Cloud controller and worker images pulled successfully.")
 
     # 5) docker compose ... up -d
     print("Starting services (docker compose up -d)...")
     up_cmd = ["docker", "compose"] + profile_args + ["up", "-d"]
     subprocess.run(up_cmd, check=True)
 
-    # 6) docker builder prune -af
-    print("Pruning Docker builder cache (docker builder prune -af)...")
-    # subprocess.run(["docker", "builder", "prune", "-af"], check=False)
+    # 6) docker builder prune -af -- off by default, since it deletes the
+    # BuildKit layer cache that makes rebuilds fast. Opt in via
+    # PRUNE_BUILDER=1; runs detached so start.py exits immediately.
+    if os.environ.get("PRUNE_BUILDER"):
+        print("Pruning Docker builder cache in the background (docker builder prune -af)...")
+        subprocess.Popen(
+            ["docker", "builder", "prune", "-af"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
 
     print("Done.")
 